@@ -84,6 +84,13 @@ sabbatical at UCLA. The experiment had two main session types:
 # the program is running in operant boxes (True) or not (False).
 operant_box_version = True
 
+# The second variable determines whether every trial event (pecks, reinforcers,
+# etc.) is printed to the terminal during the session. Writing to the terminal
+# can be slow, so these lines are handed off to a separate thread that does
+# the printing (rather than the program waiting on the terminal while the
+# bird is pecking). Set it to False to skip them altogether.
+print_trial_events = True
+
 # Prior to running any code, its conventional to first import relevant 
 # libraries for the entire script. These can range from python libraries (sys)
 # or sublibraries (setrecursionlimit) that are downloaded to every computer
@@ -92,27 +99,46 @@ operant_box_version = True
 from tkinter import Toplevel, Canvas, BOTH, TclError, Tk, Label, Button, \
     StringVar, OptionMenu, IntVar, Radiobutton, Entry
 from datetime import datetime, timedelta, date
-from time import time
-from csv import writer, DictReader, QUOTE_MINIMAL
-from os import getcwd, mkdir, path as os_path
-from random import shuffle, uniform, choice
-from sys import setrecursionlimit, path as sys_path
+from time import monotonic_ns, time_ns
+from csv import reader
+from os import getcwd, mkdir, fsync, path as os_path
+from random import Random
+from bisect import bisect
+from itertools import groupby
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from queue import SimpleQueue
+from multiprocessing import get_context
+from sys import setrecursionlimit, stdout, path as sys_path
 
-# Import hopper/other specific libraries from files on operant box computers
-try:
-    if operant_box_version:
-        cwd = getcwd()
-        sys_path.insert(0, str(os_path.expanduser('~')+"/OneDrive/Desktop/Hopper_Software"))
-        import polygon_fill
-        from hopper import HopperObject
-except ModuleNotFoundError:
-    print("ERROR :-( \n Cannot find the hopper software folder. \n Maybe a bird moved it? \n Check the trash and desktop folders and drag it to the desktop <3")
-    input()
+# Hopper/other specific libraries live in a folder on the operant box
+# computers. They are only imported when they are actually needed (the hopper
+# when the control panel is built, the paint program at the end of a session),
+# so test runs outside the boxes never go looking for them.
+hopper_software_directory = str(os_path.expanduser('~')+"/OneDrive/Desktop/Hopper_Software")
+missing_hopper_software_message = "ERROR :-( \n Cannot find the hopper software folder. \n Maybe a bird moved it? \n Check the trash and desktop folders and drag it to the desktop <3"
 
 # Below  is just a safety measure to prevent too many recursive loops). It
 # doesn't need to be changed.
 setrecursionlimit(5000)
 
+# The subject settings .csv is read with the function below. Its result is
+# cached, so starting several sessions in a row only parses the file once.
+# The file's modification time is part of the cache key, which means any
+# edits made to the sheet between sessions are still picked up.
+@lru_cache(maxsize = 4)
+def load_settings_csv(settings_csv_directory, modified_time):
+    # Returns two dictionaries: the position of each column in a row (from
+    # the header), and the rows of the settings .csv (as plain lists of
+    # values) indexed by subject name
+    with open(settings_csv_directory, 'r', encoding='utf-8-sig') as data:
+        settings_reader = reader(data)
+        column_index_dict = {column: index for index, column
+                             in enumerate(next(settings_reader, []))}
+        subject_index = column_index_dict["Subject"]
+        return column_index_dict, {row[subject_index]: row for row in settings_reader if row}
+
 """
 The code below jumpstarts the loop by first building the hopper object and 
 making sure everything is turned off, then passes that object to the
@@ -134,6 +160,18 @@ object, and a macro-level overview is:
 # relevant information (like pigeon name) and select any variations to occur 
 # within the upcoming session (sub/phase, FR, etc.)
 class ExperimenterControlPanel(object):
+    # Subject ID list, alphabetized once when the class is defined (with
+    # "TEST" always first) rather than every time a control panel is built.
+    pigeon_name_list = ("TEST",) + tuple(sorted(["Zappa", "Joplin", "Sting",
+                                                 "Jagger", "Iggy", "Evaristo",
+                                                 "Ozzy", "Kurt"]))
+    # Training phases, and a lookup from each phase's name to its number
+    # (0, 1, ...) so the number doesn't have to be found by searching the list
+    training_phase_name_list = ("0: Pre-Training",
+                                "1: Sub-Optimal Choice Training")
+    training_phase_index_dict = {phase_name: phase_index for phase_index, phase_name
+                                 in enumerate(training_phase_name_list)}
+    
     # The init function declares the inherent variables within that object
     # (meaning that they don't require any input).
     def __init__(self):
@@ -150,37 +188,39 @@ class ExperimenterControlPanel(object):
             self.data_folder = "P037_data" # The folder within Documents where subject data is kept
             self.data_folder_directory = str(os_path.expanduser('~'))+"/OneDrive/Desktop/Data/" + self.data_folder
         # Set hopper object to be a variable of self, so it can be referenced...
+            try:
+                sys_path.insert(0, hopper_software_directory)
+                from hopper import HopperObject
+            except ModuleNotFoundError:
+                print(missing_hopper_software_message)
+                input()
             self.Hopper = HopperObject()
         else: # If not, just save in the current directory the program us being run in 
             self.data_folder_directory = getcwd() + "/Data/"
             self.Hopper = None
         
+        # Names of pigeons whose data folders have already been checked for
+        # (or created) during this run of the program
+        self.checked_data_folders = set()
+        
         # setup the root Tkinter window
         self.control_window = Tk()
         self.control_window.title("P037 Control Panel")
         ##  Next, setup variables within the control panel:
-        # Subject ID list (need to build/alphabetize) - TBD
-        self.pigeon_name_list = ["Zappa", "Joplin", "Sting",
-                                 "Jagger", "Iggy", "Evaristo",
-                                 "Ozzy", "Kurt"]
-        self.pigeon_name_list.sort() # This alphabetizes the list
-        self.pigeon_name_list.insert(0, "TEST")
-        # Subject ID menu and label
+        # Subject ID menu and label (names come from pigeon_name_list above)
         Label(self.control_window, text="Pigeon Name:").pack()
         self.subject_ID_variable = StringVar(self.control_window)
         self.subject_ID_variable.set("Select")
         self.subject_ID_menu = OptionMenu(self.control_window,
                                           self.subject_ID_variable,
                                           *self.pigeon_name_list,
-                                          command=self.set_pigeon_ID).pack()
+                                          command=self.set_pigeon_ID)
+        self.subject_ID_menu.pack()
         
         # Training phases
         Label(self.control_window, text = "Select experimental phase:").pack()
         self.training_phase_variable = StringVar() # This is the literal text of the phase, e.g., "0: Autoshaping"
         self.training_phase_variable.set("Select") # Default
-        self.training_phase_name_list = ["0: Pre-Training",
-                                         "1: Sub-Optimal Choice Training"
-                                    ]
         self.training_phase_menu = OptionMenu(self.control_window,
                                           self.training_phase_variable,
                                           *self.training_phase_name_list)
@@ -197,7 +237,8 @@ class ExperimenterControlPanel(object):
               text = "Pre-Training FR:").pack()
         self.preTraining_FR_stringvar = StringVar()
         self.preTraining_FR_variable = Entry(self.control_window, 
-                                     textvariable = self.preTraining_FR_stringvar).pack()
+                                     textvariable = self.preTraining_FR_stringvar)
+        self.preTraining_FR_variable.pack()
         self.preTraining_FR_stringvar.set(1)
         
         # Forced choice variable? Y/N binary radio button
@@ -223,11 +264,13 @@ class ExperimenterControlPanel(object):
         self.record_data_rad_button1 =  Radiobutton(self.control_window,
                                    variable = self.record_data_variable,
                                    text = "Yes",
-                                   value = True).pack()
+                                   value = True)
+        self.record_data_rad_button1.pack()
         self.record_data_rad_button2 = Radiobutton(self.control_window,
                                   variable = self.record_data_variable,
                                   text = "No",
-                                  value = False).pack()
+                                  value = False)
+        self.record_data_rad_button2.pack()
         self.record_data_variable.set(True) # Default set to True
         
         
@@ -235,7 +278,8 @@ class ExperimenterControlPanel(object):
         self.start_button = Button(self.control_window,
                                    text = 'Start program',
                                    bg = "green2",
-                                   command = self.build_chamber_screen).pack()
+                                   command = self.build_chamber_screen)
+        self.start_button.pack()
         
         # This makes sure that the control panel remains onscreen until exited
         self.control_window.mainloop() # This loops around the CP object
@@ -244,7 +288,11 @@ class ExperimenterControlPanel(object):
     def set_pigeon_ID(self, pigeon_name):
         # This function checks to see if a pigeon's data folder currently 
         # exists in the respective "data" folder within the Documents
-        # folder and, if not, creates one.
+        # folder and, if not, creates one. Each pigeon only needs to be
+        # checked once per run, so re-selecting the same bird (or another
+        # session with it) skips the trip to the OneDrive-synced disk.
+        if pigeon_name in self.checked_data_folders:
+            return
         if operant_box_version:
             try:
                 if not os_path.isdir(self.data_folder_directory + pigeon_name):
@@ -257,6 +305,7 @@ class ExperimenterControlPanel(object):
             if not os_path.isdir(parent_directory + pigeon_name):
                 mkdir(os_path.join(parent_directory, pigeon_name))
                 print("\n ** NEW DATA FOLDER FOR %s CREATED **" % pigeon_name.upper())
+        self.checked_data_folders.add(pigeon_name)
                 
     def build_chamber_screen(self):
         # Once the green "start program" button is pressed, then the mainscreen
@@ -270,26 +319,96 @@ class ExperimenterControlPanel(object):
                                              self.record_data_variable.get(), # Boolean for recording data (or not)
                                              self.data_folder_directory, # directory for data folder
                                              self.training_phase_variable.get(), # Which training phase
-                                             self.training_phase_name_list, # list of training phases
-                                             self.preTraining_FR_stringvar.get() # Manual FR
+                                             self.preTraining_FR_stringvar.get(), # Manual FR
+                                             self.reset_widgets # Function called once the session ends
                                              # self.forced_choice_variable.get(), # Forced choice Boolean
                                              ]
                 print(f"{'SESSION STARTED': ^15}") 
-                self.MS = MainScreen(*list_of_variables_to_pass)
+                # Only one session can run at a time, so the start button is
+                # disabled until this one ends (see reset_widgets)
+                self.start_button.configure(state = "disabled")
+                try:
+                    self.MS = MainScreen(*list_of_variables_to_pass)
+                except Exception:
+                    # If the session couldn't even be set up, it will never
+                    # end either, so the start button is turned back on here
+                    self.start_button.configure(state = "normal")
+                    raise
             else:
                 print("\nERROR: Input Experimental Phase Before Starting Session")
         else:
             print("\nERROR: Input Correct Pigeon ID Before Starting Session")
+    
+    def reset_widgets(self):
+        # This function is called by the MainScreen once its session has
+        # ended. The control panel and its widgets stay alive between
+        # sessions rather than being rebuilt; they are just reset so the next
+        # session can be set up. The other selections (phase, FR, etc.) are
+        # kept, since they're usually the same for the next bird.
+        self.subject_ID_variable.set("Select")
+        self.start_button.configure(state = "normal")
             
 
 # Next, setup the MainScreen object
 class MainScreen(object):
+    # Coordinate dictionary for the shapes around a key. The keys are 
+    # given in (x1, y1, x2, y2) coordinates. These never change, so they are
+    # defined once for the class rather than rebuilt whenever keys are drawn.
+    key_coord_dict = {"left_choice_key": (150, 250, 250, 350),
+                      "right_choice_key": (550, 250, 650, 350),
+                      "rejection_key": (350, 250, 450, 350),
+                      "ll_feedback_key": (150, 250, 250, 350),
+                      "lr_feedback_key": (150, 250, 250, 350),
+                      "rl_feedback_key": (550, 250, 650, 350),
+                      "rr_feedback_key": (550, 250, 650, 350)
+                      }
+    # The rejection key has a cross drawn on top of it, made of two bars
+    # (vertical, then horizontal) that are each a fifth of the key wide and
+    # span the middle 80% of it. Their (x1, y1, x2, y2) coordinates within
+    # the rejection key's (350, 250, 450, 350) box are:
+    rejection_cross_coords = ((390, 260, 410, 340),
+                              (360, 290, 440, 310))
+    # Once a rejection key is pecked, both choice keys are covered up by a
+    # black rectangle. Their (x1, y1, x2, y2) coordinates (left, then right)
+    # are:
+    rejection_cover_coords = ((100, 200, 300, 400),
+                              (500, 200, 700, 400))
+    # The trial types making up one block of each training phase are also
+    # fixed, so they are built once here too. build_trial_block() shuffles
+    # its own copy of a block, so these are never changed.
+    pretraining_trial_options = (
+        "rejection_key",
+        "left_choice_key",
+        "right_choice_key",
+        "ll_feedback_key",
+        "lr_feedback_key",
+        "rl_feedback_key",
+        "rr_feedback_key"
+        ) * 8
+    rejection_training_trial_options = (
+        "forced_choice-informative",
+        "forced_choice-noninformative"
+        )  * 10 + (
+            "rejection-informative",
+            "rejection-noninformative"
+            ) * 10 + (
+                "free_choice",) * 10
+    # Trial types in which the outcome is sampled without replacement (see
+    # feedback_stage)
+    forced_choice_trial_types = frozenset(("forced_choice-informative",
+                                           "forced_choice-noninformative"))
+    # And trial types in which the rejection key is shown alongside a choice
+    # key (see key_press)
+    rejection_trial_types = frozenset(("rejection-informative",
+                                       "rejection-noninformative"))
+    
     # We need to declare several functions that are 
     # called within the initial __init__() function that is 
     # run when the object is first built:
     
     def __init__(self, Hopper, subject_ID, record_data, data_folder_directory,
-                 training_phase, training_phase_name_list, preTraining_FR #, forced_choice_session
+                 training_phase, preTraining_FR,
+                 session_end_function = None #, forced_choice_session
                  ):
         ## Firstly, we need to set up all the variables passed from within
         # the control panel object to this MainScreen object. We do this 
@@ -297,23 +416,28 @@ class MainScreen(object):
         # within this object.
         
         # Setup training phase
-        self.training_phase = training_phase_name_list.index(training_phase) # Starts at 0 **
-        self.training_phase_name_list = training_phase_name_list
+        # (the list of phases and their index both come from the control
+        # panel class, so there's only one list of them to keep up to date)
+        self.training_phase_name_list = ExperimenterControlPanel.training_phase_name_list
+        self.training_phase = ExperimenterControlPanel.training_phase_index_dict[training_phase] # Starts at 0 **
         
         
         # Setup data directory
         self.data_folder_directory = data_folder_directory
         
         ## Set the other pertanent variables given in the command window
+        self.session_end_function = session_end_function # Called after the session's window is destroyed
         self.subject_ID = subject_ID
         self.record_data = record_data
+        # The FR entry is parsed into an int exactly once, here; every trial
+        # after this just copies the int (the entry's StringVar is never
+        # read again).
+        self.preTraining_FR = 1 # Default FR (always used outside of pre-training)
         if self.training_phase == 0: # If pre-training, we can modulate FR
             try:
                 self.preTraining_FR = int(preTraining_FR) # Number of times the oberving key should be pressed for the target to appear 
             except ValueError:
-                print("\nERROR: Incorrect Manual FR Input")
-        else:
-            self.preTraining_FR = 1
+                print("\nERROR: Incorrect Manual FR Input (FR 1 used instead)")
 # =============================================================================
 #         # Including forced choice variables
 #         self.forced_choice_session = forced_choice_session
@@ -326,14 +450,17 @@ class MainScreen(object):
         self.mainscreen_height = 600 # height of the experimental canvas screen
         self.mainscreen_width = 800 # width of the experimental canvas screen
         self.root.bind("<Escape>", self.exit_program) # bind exit program to the "esc" key
+        # Closing the window also has to go through exit_program so that the
+        # open data file is flushed and closed properly
+        self.root.protocol("WM_DELETE_WINDOW", self.exit_program)
         
         # If the version is the one running in the boxes...
         if operant_box_version: 
             # Keybind relevant keys
             self.cursor_visible = True # Cursor starts on...
-            self.change_cursor_state() # turn off cursor UNCOMMENT
+            self.set_cursor_state(False) # turn off cursor UNCOMMENT
             self.root.bind("<c>", # bind cursor on/off state to "c" key
-                           lambda event: self.change_cursor_state()) 
+                           self.change_cursor_state)
             
             # Then fullscreen (on a 800x600p screen)
             self.root.attributes('-fullscreen', True)
@@ -350,16 +477,28 @@ class MainScreen(object):
                                    width = self.mainscreen_width)
             self.mastercanvas.pack()
             
+        # Draw all of the (hidden) keys onto the Canvas
+        self.build_key_items()
+            
         # Function to provide manual reinforcer (not active)
         #self.root.bind("<m>",lambda event: self.manual_reinforcer())
             
-        # Setup hopper (passed from the control panel)
+        # Setup hopper (passed from the control panel). Commands to the hopper
+        # hardware are carried out by a single background worker thread (see
+        # change_hopper_state below) so they never hold up the Tk mainloop.
         self.Hopper = Hopper
+        if operant_box_version:
+            self.hopper_executor = ThreadPoolExecutor(max_workers = 1)
+            self.hopper_state_function = Hopper.change_hopper_state # Looked up once, rather than every time the hopper moves
         
         # Timing variables
         self.start_time = None # This will be reset once the session actually starts
-        self.trial_start = None # Duration into each trial as a second count, resets each trial
-        self.session_duration = datetime.now() + timedelta(minutes = 90) # Max session time is 90 min
+        self.session_start = None # Monotonic ns count at the start of the session (used to time events)
+        self.trial_start = None # Start of each trial (once its ITI is over) as a monotonic ns count, resets each trial
+        self.trial_stage = "NA" # Substage of the current trial (set once the first trial's keys are shown)
+        self.trial_type = "NA" # Type of the current trial (set by each ITI)
+        self.session_max_duration = 90 * 60 * 10**9 # Max session time is 90 min (in ns)
+        self.session_deadline = None # Monotonic ns count the session times out at, set once the session starts
         self.ITI_duration = 10 * 1000 # duration of inter-trial interval (ms)
         if self.subject_ID == "TEST":
             self.feedback_duration = 5 * 1000 # duration of post-choice feedback (ms)
@@ -373,20 +512,47 @@ class MainScreen(object):
         self.informative_prob = 0.2
         self.noninformative_prob = 0.5
         self.rejection_FI_duration = 1 # Duration of rejection key FI (ms)
+        self.pending_after_IDs = [] # IDs of the callbacks scheduled via root.after() since the last ITI, so they can be cancelled
         # Max number of trials within a session differ by phase and was set 
         # later in the first-ITI function
         
         # Here are variables for data structuring 
-        self.session_data_frame = [] #This where trial-by-trial data is stored
-        header_list = ["SessionTime", "Xcord","Ycord", "LocationEvent",
+        self.session_data_frame = [] # This is where trial-by-trial data is buffered until it is written to the .csv
+        self.header_list = ["SessionTime", "Xcord","Ycord", "LocationEvent",
                        "ExperimentalEvent", "TrialStage", "TrialTime", 
                        "TrialFR", "TrialNum", "ReinforcersProvided", "TrialType",
                        "RejectedTrial", "RejectionFIDuration", 
                        "InformativeProbability", "NoninformativeProbability",
-                       "Subject", "TrainingPhase", "Date"] # Column headers
-        
-        self.session_data_frame.append(header_list) # First row of matrix is the column headers
+                       "Subject", "TrainingPhase", "Date", "RandomSeed",
+                       "PeckCount"] # Column headers
+        self.data_file = None # Data .csv file object, opened once the session starts
+        self.background_peck_count = 0 # Background pecks counted onto the latest background peck row (see background_peck)
+        self.background_peck_row_index = None # Position of that row in session_data_frame
+        self.background_peck_after_ID = None # ID of the after_idle() call that finishes the row
+        self.trial_event_queue = SimpleQueue() # Terminal feedback lines waiting to be printed
+        self.trial_event_printer = Thread(target = self.print_queued_trial_events,
+                                          daemon = True) # Prints them as they arrive
+        self.trial_event_printer.start()
+        self.exp_outcome_dict = {} # Location-independent name of each type of peck (filled in once the session's settings are known)
+        # Every row follows the same fixed schema of plain numbers and
+        # strings (none containing commas, see session_row_tail), so rows
+        # are formatted straight into this template rather than being
+        # passed through csv.writer.
+        self.row_format = ",".join(["{}"] * len(self.header_list)) + "\r\n"
+        self.session_row_tail = () # Columns shared by every row of the session (set once the session starts)
         self.date = date.today().strftime("%y-%m-%d") # Today's date
+        
+        # All of the session's random draws (trial order, outcomes, feedback
+        # colors) come from this session-specific random number generator
+        # rather than the random module's shared global one. Its seed is saved
+        # with every data row so a session's sequence can be reproduced.
+        self.random_seed = time_ns()
+        self.rng = Random(self.random_seed)
+        # Its methods are bound to attributes once, so each draw is a single
+        # lookup rather than going through self.rng every time.
+        self.random_draw = self.rng.random # Float in [0, 1)
+        self.random_shuffle = self.rng.shuffle # Shuffles a list in place
+        self.random_choice = self.rng.choice # Random item of a list
 
         ## Finally, start the recursive loop that runs the program:
         self.place_birds_in_box()
@@ -402,9 +568,13 @@ class MainScreen(object):
             # objects off the mainscreen (making it blank), unbinds the spacebar to 
             # the first_ITI link, followed by a 30s pause before the first trial to 
             # let birds settle in and acclimate.
-            self.mastercanvas.delete("all")
+            self.clear_canvas()
+            self.mastercanvas.delete("start_text") # The start screen's text is never shown again
             self.root.unbind("<space>")
-            self.start_time = datetime.now() # Set start time
+            self.start_time = datetime.now() # Set start time (wall-clock, used to name the data file)
+            self.session_start = monotonic_ns() # Cheap monotonic clock reading that events are timed from
+            self.session_deadline = self.session_start + self.session_max_duration
+            self.open_data_file() # Open the .csv that data will be written to
             
             # Then we can read the settings .csv to set up subject-specific 
             # parameters for this session.
@@ -413,40 +583,64 @@ class MainScreen(object):
             else:
                 settings_csv_directory = "P037_Settings-Assignments.csv"
             
-            # Next, check if the csv file exists.
-            settings_list = []
+            # Next, check if the csv file exists. If it does, its rows are
+            # loaded (see load_settings_csv at the top) into a dictionary
+            # indexed by subject name, so the subject's settings can be looked
+            # up directly instead of scanning through every row, along with
+            # the position of each column.
+            settings_columns, settings_by_subject = {}, {}
             if os_path.isfile(settings_csv_directory):
-                # Read the content of the csv as a dictionary
-                with open(settings_csv_directory, 'r', encoding='utf-8-sig') as data:
-                    for line in DictReader(data):
-                        settings_list.append(line)
+                try:
+                    settings_columns, settings_by_subject = load_settings_csv(settings_csv_directory,
+                                                                              os_path.getmtime(settings_csv_directory))
+                except KeyError:
+                    print("Error reading settings .csv.\n Make sure it is in comma-dilimeted form.")
             else:
                 print("Error: cannot find settings csv file!")
                 input()
-            # After we have a list off the settings for all subjects converted 
-            # into a Python-friendly data form (list of dictionaries), we can 
-            # narrow it down to a single subject-specific dictionary
-            settings_dict = "NA"
-            try:
-                for entry in settings_list:
-                    if entry["Subject"] == self.subject_ID:
-                        settings_dict = entry
-            except KeyError:
-                print("Error reading settings .csv.\n Make sure it is in comma-dilimeted form.")
+            # Then we can narrow it down to a single subject-specific row
+            # (None if the subject isn't in the sheet)
+            settings_row = settings_by_subject.get(self.subject_ID)
                     
-            # And we can then update subject-specific settings...
-            print(settings_dict)
+            # And we can then update subject-specific settings, pulling each
+            # value out of the row by its column's position...
+            if settings_row is not None:
+                print(dict(zip(settings_columns, settings_row))) # Each setting alongside its column
+            else:
+                print(settings_row)
             try:
-                self.hopper_duration = int(settings_dict["Hopper Duration (ms)"])
-                self.rejection_FI_duration = int(settings_dict["Rejection FI Duration (ms)"])
-                self.informative_side = settings_dict["Informative Side"]
-                self.informative_Splus_color = settings_dict["Informative S+"]
-                self.informative_Sminus_color = settings_dict["Informative S-"]
-                self.noninformative_side = settings_dict["Non-Informative Side"]
-                self.noninformative_Splus_color = settings_dict["Non-Informative S+"]
-                self.noninformative_Sminus_color = settings_dict["Non-Informative S-"]
-            except TypeError:
-                print("Error: Unable to import Settings Sheet for {self.subject_ID}")
+                self.hopper_duration = int(settings_row[settings_columns["Hopper Duration (ms)"]])
+                self.rejection_FI_duration = int(settings_row[settings_columns["Rejection FI Duration (ms)"]])
+                self.informative_side = settings_row[settings_columns["Informative Side"]]
+                self.informative_Splus_color = settings_row[settings_columns["Informative S+"]]
+                self.informative_Sminus_color = settings_row[settings_columns["Informative S-"]]
+                self.noninformative_side = settings_row[settings_columns["Non-Informative Side"]]
+                self.noninformative_Splus_color = settings_row[settings_columns["Non-Informative S+"]]
+                self.noninformative_Sminus_color = settings_row[settings_columns["Non-Informative S-"]]
+            except (TypeError, KeyError, IndexError): # (IndexError if the subject's row is missing cells)
+                print(f"Error: Unable to import Settings Sheet for {self.subject_ID}")
+            # The last columns of every data row are the same for the whole
+            # session, so they're collected here once (see write_comp_data)
+            self.session_row_tail = (
+                self.rejection_FI_duration, # FI duration (fixed across session)
+                self.informative_prob, # Probability of an informative win
+                self.noninformative_prob, # Probability of a non-info win
+                self.subject_ID, # Name of subject (same across datasheet)
+                self.training_phase, # Phase of training as a number (0 - 7)
+                date.today(), # Today's date as "YYYY-MM-DD" (the day the session started)
+                self.random_seed # Seed of the session's random number generator
+                )
+            # Rows are written without going through csv quoting (see
+            # row_format), which only works as long as no value contains a
+            # comma, quote or line break. The columns that change during a
+            # session are all numbers or fixed names, so only these values
+            # (really just the subject's name) ever could, and if so they're
+            # quoted the way csv would quote them, here, once.
+            self.session_row_tail = tuple(
+                '"' + value.replace('"', '""') + '"'
+                if isinstance(value, str) and any(character in value for character in ',"\r\n')
+                else value
+                for value in self.session_row_tail)
             # And create a dictionary with key color assignments:
             if self.informative_side == "Left":
                 self.key_color_dict = {"left_choice_key": "white",
@@ -466,6 +660,42 @@ class MainScreen(object):
                                       "rr_feedback_key": self.informative_Sminus_color,
                                       "rejection_key": "white"
                                       }                                 
+            # We also need the reverse lookup (from a color to the first key
+            # with that color) to find the feedback key for a feedback color
+            self.color_key_dict = {key_color: key_string for key_string, key_color
+                                   in reversed(self.key_color_dict.items())}
+            # Now that the colors are known, fill in the (still hidden) keys
+            for key_string, key_color in self.key_color_dict.items():
+                self.mastercanvas.itemconfigure(self.key_oval_dict[key_string],
+                                                fill = key_color)
+            # The sides are fixed for the whole session, so we can also look
+            # up the name of each option's choice key once here instead of
+            # rebuilding the string every time keys are built or a choice is
+            # scored.
+            self.informative_choice_key = f"{self.informative_side.lower()}_choice_key"
+            self.noninformative_choice_key = f"{self.noninformative_side.lower()}_choice_key"
+            # For the same reason, the translation of each key peck's
+            # (location-dependent) event name into experimental terms for the
+            # data file is worked out once here, so write_data() only has to
+            # look it up. Feedback keys are translated by their color; if two
+            # of the session's colors are the same, the first one listed wins.
+            self.exp_outcome_dict = {
+                f"{self.informative_choice_key}_peck": "informative_key_peck",
+                f"{self.noninformative_choice_key}_peck": "uninformative_key_peck",
+                "rejection_key_peck": "rejection_key_peck",
+                "rejection-informative_peck": "rejection_key_peck",
+                "rejection-noninformative_peck": "rejection_key_peck"
+                }
+            feedback_color_outcome_dict = {}
+            for feedback_color, feedback_outcome in ((self.informative_Splus_color, "informative_Splus_peck"),
+                                                     (self.informative_Sminus_color, "informative_Sminus_peck"),
+                                                     (self.noninformative_Splus_color, "noninformative_Splus_peck"),
+                                                     (self.noninformative_Sminus_color, "noninformative_Sminus_peck")):
+                feedback_color_outcome_dict.setdefault(feedback_color, feedback_outcome)
+            for key_string in ("ll_feedback_key", "lr_feedback_key",
+                               "rl_feedback_key", "rr_feedback_key"):
+                if self.key_color_dict[key_string] in feedback_color_outcome_dict:
+                    self.exp_outcome_dict[f"{key_string}_peck"] = feedback_color_outcome_dict[self.key_color_dict[key_string]]
             # Next, we can set up the order of each trial within the session.
             # The total number of trials per session differs based on whether
             # the session is a pre-training (100% reinforced) or training 
@@ -473,27 +703,12 @@ class MainScreen(object):
             
             if self.training_phase == 0: # pre-training
                 self.trials_per_session = 56 # 7 trial types * 8 iterations
-                trial_option_list = [
-                    "rejection_key",
-                    "left_choice_key",
-                    "right_choice_key",
-                    "ll_feedback_key",
-                    "lr_feedback_key",
-                    "rl_feedback_key",
-                    "rr_feedback_key"
-                    ] * 8
+                trial_option_list = self.pretraining_trial_options
                 
             
             elif self.training_phase == 1: # rejection training
                 self.trials_per_session = 100
-                trial_option_list = [
-                    "forced_choice-informative",
-                    "forced_choice-noninformative"
-                    ]  * 10 + [
-                        "rejection-informative",
-                        "rejection-noninformative"
-                        ] * 10 + [
-                            "free_choice"] *10
+                trial_option_list = self.rejection_training_trial_options
                             
                 # Next step is setting up the sampling without replacement for 
                 # the forced choice trials. To do this, we need to seperate out
@@ -507,30 +722,57 @@ class MainScreen(object):
                 self.forced_I_choice_outcome_list = ["win"] * (int(self.informative_prob * 20)) + ["loss"] * (int((1 - self.informative_prob) * 20))
                 self.forced_NI_choice_outcome_list = ["win"] * (int(self.noninformative_prob * 20)) + ["loss"] * (int((1 - self.noninformative_prob) * 20))
                 self.forced_NI_choice_feedback_list = [self.noninformative_Splus_color] * (int(self.informative_prob * 20)) + [self.noninformative_Sminus_color] * (int((1 - self.informative_prob) * 20))
+                # Each list is shuffled once here, so sampling without
+                # replacement during the session is just taking the last
+                # item off the end of the list.
+                self.random_shuffle(self.forced_I_choice_outcome_list)
+                self.random_shuffle(self.forced_NI_choice_outcome_list)
+                self.random_shuffle(self.forced_NI_choice_feedback_list)
+                
+                # The keys shown during the choice stage of a trial only
+                # depend on its trial type and whether it has been rejected,
+                # so we can work them out for every combination up front
+                # (build_keys then just looks them up). Once rejected, only
+                # the alternative option is shown.
+                self.choice_keys_dict = {
+                    ("forced_choice-informative", False): (self.informative_choice_key,),
+                    ("forced_choice-noninformative", False): (self.noninformative_choice_key,),
+                    ("rejection-informative", False): (self.informative_choice_key, "rejection_key"),
+                    ("rejection-noninformative", False): (self.noninformative_choice_key, "rejection_key"),
+                    ("free_choice", False): (self.informative_choice_key, self.noninformative_choice_key),
+                    ("rejection-informative", True): (self.noninformative_choice_key,),
+                    ("rejection-noninformative", True): (self.informative_choice_key,)
+                    }
+                
+                # Free non-informative choices have two independent outcomes
+                # (reinforced or not, then S+ or S- colored feedback), which
+                # can be combined into one table of the four possible
+                # (reinforced, color) pairs. A single random draw then picks
+                # a pair by where it falls in the running total of their
+                # probabilities (see feedback_stage).
+                self.noninformative_outcome_tuple = (
+                    (True, self.noninformative_Splus_color),
+                    (True, self.noninformative_Sminus_color),
+                    (False, self.noninformative_Splus_color),
+                    (False, self.noninformative_Sminus_color)
+                    )
+                self.noninformative_cum_weights = (
+                    self.noninformative_prob * self.informative_prob,
+                    self.noninformative_prob,
+                    self.noninformative_prob + (1 - self.noninformative_prob) * self.informative_prob
+                    ) # The last pair covers everything above the third total
                 
                 
             # Once we have the number of trials per session (and what type of
             # trials they will be), we can semi-randomly determine the order.
             # The key here will be that we're avoiding repeats of four or more
-            # of the same trial type.
-            self.trial_order_list = []
-            
-            while len(self.trial_order_list) != self.trials_per_session:
-                shuffle(trial_option_list) # shuffle
-                approved = True
-                c = 0  # counter
-                while c < len(trial_option_list) and approved:
-                    if c > 3:
-                        a = trial_option_list[c]
-                        if a == trial_option_list[c-1] and a == trial_option_list[c-2] and a == trial_option_list[c-3]:
-                            approved = False
-                    c += 1
-                if approved:
-                    for i in trial_option_list:
-                        self.trial_order_list.append(i)
+            # of the same trial type. Each block (one copy of trial_option_list)
+            # is ordered separately, and only once the trials of the previous
+            # block have all been run (see trial_type_generator).
+            self.upcoming_trial_types = self.trial_type_generator(trial_option_list)
   
-            # Now we have the type of every sequential trial within the session
-            # and we can get started!
+            # Now we have a source for the type of every sequential trial
+            # within the session and we can get started!
                 
 # =============================================================================
 #                 # Importantly, we need to change the trial type if its a forced
@@ -541,21 +783,45 @@ class MainScreen(object):
 
             
             # After we ~finally~ set up the stimulus order, we need to set up 
-            # a timer and move on to the ITI
+            # a timer and move on to the ITI (timers are given the bound
+            # methods directly, with no lambda wrapped around them)
             
             if self.subject_ID == "TEST": # If test, don't worry about first ITI delay
                 self.ITI_duration = 1 * 1000
-                self.root.after(1, lambda: self.ITI())
+                self.ITI() # Go straight to the ITI, rather than through a 1 ms timer
             else:
-                self.root.after(30000, lambda: self.ITI())
+                self.schedule(30000, self.ITI)
 
         self.root.bind("<space>", first_ITI) # bind cursor state to "space" key
         self.mastercanvas.create_text(350,300,
                                       fill="white",
                                       font="Times 20 italic bold",
-                                      text=f"P037 \n Place bird in box, then press space \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]}")
+                                      text=f"P037 \n Place bird in box, then press space \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]}",
+                                      tag = "start_text")
         
                 
+    def build_trial_block(self, trial_option_list):
+        # This function returns a shuffled copy of a block of trial types in
+        # which no trial type occurs more than three times in a row. Rather
+        # than stepping through the list comparing each trial to the three
+        # before it, the length of every run of identical trial types is
+        # measured in one pass with groupby(), and the block is simply
+        # reshuffled until its longest run is short enough. Reshuffling
+        # (rather than patching up a bad block) keeps every acceptable order
+        # equally likely.
+        trial_block = list(trial_option_list)
+        self.random_shuffle(trial_block)
+        while max(sum(1 for _ in run) for _, run in groupby(trial_block)) > 3:
+            self.random_shuffle(trial_block)
+        return trial_block
+    
+    def trial_type_generator(self, trial_option_list):
+        # This generator yields the type of each trial of the session in
+        # order, block by block, until the session's trial count is reached.
+        number_of_blocks = self.trials_per_session // len(trial_option_list)
+        for block in range(number_of_blocks):
+            yield from self.build_trial_block(trial_option_list)
+                
 ## %% ITI
 
     # Every trial (including the first) "starts" with an ITI. The ITI function
@@ -566,21 +832,19 @@ class MainScreen(object):
     #   4) Moves on to the next trial after a delay (ITI)
     # 
     def ITI (self):
+        # A new trial starts here, so nothing scheduled during the last one
+        # should still go off (e.g., a second timer left over from an
+        # unusual burst of pecks). Any background pecks still being counted
+        # are finished first, since they belong to the last trial.
+        self.write_background_pecks()
+        self.cancel_pending_timers()
+        
         # This function just clear the screen. It will be used a lot in the future, too.
         self.clear_canvas()
         
-        # Make sure pecks during ITI are saved...
-        self.mastercanvas.create_rectangle(0,0,
-                                           self.mainscreen_width,
-                                           self.mainscreen_height,
-                                           fill = "black",
-                                           outline = "black",
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "ITI_peck": 
-                                       self.write_data(event, event_type))
+        # Make sure pecks during ITI are saved (as ITI pecks)...
+        self.background_event_type = "ITI_peck"
+        self.mastercanvas.itemconfigure("bkgrd", state = "normal")
         
         # First, check to see if any session limits have been reached (e.g.,
         # if the max time or reinforcers earned limits are reached).
@@ -589,7 +853,7 @@ class MainScreen(object):
             self.exit_program("event")
             
 # =============================================================================
-#         elif datetime.now() >= (self.session_duration):
+#         elif monotonic_ns() >= self.session_deadline:
 #             print("Time max reached")
 #             self.exit_program("event")
 # =============================================================================
@@ -600,42 +864,46 @@ class MainScreen(object):
         else: 
             # Print text on screen if a test (should be black if an experimental trial)
             if not operant_box_version or self.subject_ID == "TEST":
-                self.mastercanvas.create_text(400,300,
-                                              fill="white",
-                                              font="Times 20 italic bold",
-                                              text=f"ITI ({int(self.ITI_duration/1000)} sec.)")
+                self.mastercanvas.itemconfigure("ITI_text",
+                                                text = f"ITI ({int(self.ITI_duration/1000)} sec.)",
+                                                state = "normal")
                 
             # This calls the Hopper function to turn it off, and resets other
             # variables. The hopper should be turned off in the previous function,
             # but this is an additional safeguard just to be safe.
             if operant_box_version:
-                self.Hopper.change_hopper_state("Off")
+                self.change_hopper_state("Off")
                 
             # Reset other variables for the following trial.
-            self.trial_start = time() # Set trial start time (note that it includes the ITI, which is subtracted later)
+            self.trial_start = monotonic_ns() + self.ITI_duration * 1000000 # Set trial start time in integer ns (the ITI is added here, once, rather than subtracted from every event's trial time)
             self.choice = None # Reset the choice tracker
             self.rejected_trial = False # Resets a rejected trial
             self.write_comp_data(False) # update data .csv with trial data from the previous trial
             
-            # Next up, set the sample key FR for this upcoming
-            if self.training_phase == 0:
-                self.choice_key_FR = self.preTraining_FR
-            else:
-                self.choice_key_FR = 1
+            # Next up, set the sample key FR for this upcoming trial (always 1
+            # outside of pre-training)
+            self.choice_key_FR = self.preTraining_FR
                 
             # Next up, set the string that tracks the trial type
-            self.trial_type = self.trial_order_list[self.current_trial_counter]
+            self.trial_type = next(self.upcoming_trial_types)
+            # Pecks to the rejection key are recorded under the kind of
+            # rejection trial they're in (e.g., "rejection-informative_peck"),
+            # which is set here once per trial rather than on every peck
+            if self.trial_type in self.rejection_trial_types:
+                self.key_peck_outcome_dict["rejection_key"] = f"{self.trial_type}_peck"
+            else:
+                self.key_peck_outcome_dict["rejection_key"] = "rejection_key_peck"
 
             # Increase trial counter by one
             self.current_trial_counter += 1
             
             # Next, set a delay timer to proceed to the next trial
-            self.root.after(self.ITI_duration,
-                            lambda: self.initial_links_stage())
+            self.schedule(self.ITI_duration,
+                          self.initial_links_stage)
             
-            # Finally, print terminal feedback "headers" for each event within the next trial
-            print(f"\n{'*'*40} Trial {self.current_trial_counter} begins {'*'*40}") # Terminal feedback...
-            print(f"{'Event Type':>30} | Xcord. Ycord. | Stage |  Session Time  | Trial Type")
+            # Finally, print the "headers" for each event within the next trial
+            self.print_trial_event(f"\n{'*'*40} Trial {self.current_trial_counter} begins {'*'*40}") # Terminal feedback...
+            self.print_trial_event(f"{'Event Type':>30} | Xcord. Ycord. | Stage |  Session Time  | Trial Type")
         
 #    #%%  Pre-choice loop 
     """
@@ -663,19 +931,20 @@ class MainScreen(object):
     def initial_links_stage(self):
         # This is the first part of the trial in which initial links (or choice
         # keys are presented)
+        self.write_background_pecks() # Earlier background pecks belong to the previous stage
         self.clear_canvas()
         self.trial_stage = 0
         self.build_keys()
 
     def feedback_stage(self):
+        self.write_background_pecks() # Earlier background pecks belong to the previous stage
         self.clear_canvas()
         self.trial_stage = 1
         # If an informative choice...
-        if self.choice.split("_")[0] == self.informative_side.lower():
+        if self.choice == self.informative_choice_key:
             # For not forced choice trials
-            if "forced" not in self.trial_type:
-                random_choice = uniform(0,1)
-                if random_choice <= self.informative_prob:
+            if self.trial_type not in self.forced_choice_trial_types:
+                if self.random_draw() < self.informative_prob:
                     reinforced = True
                     feedback_color = self.informative_Splus_color
                 else:
@@ -683,8 +952,7 @@ class MainScreen(object):
                     feedback_color = self.informative_Sminus_color
             # For forced choice...
             else:
-                outcome = choice(self.forced_I_choice_outcome_list) # Sample...
-                self.forced_I_choice_outcome_list.remove(outcome) # ...without replacement
+                outcome = self.forced_I_choice_outcome_list.pop() # Sample without replacement (list is pre-shuffled)
                 if outcome == "win":
                     reinforced = True
                     feedback_color = self.informative_Splus_color
@@ -694,119 +962,73 @@ class MainScreen(object):
                     
         # If non-informative choice
         else:
-            if "forced" not in self.trial_type:
-                # 50% chance of reinforcement, equal chance of S+ or S- as informative
-                # First outcome...
-                random_choice = uniform(0,1)
-                if random_choice <= self.noninformative_prob:
-                    reinforced = True
-                else:
-                    reinforced = False
-                # Then feedback color
-                random_choice = uniform(0,1)
-                if random_choice <= self.informative_prob:
-                    feedback_color = self.noninformative_Splus_color
-                else:
-                    feedback_color = self.noninformative_Sminus_color
+            if self.trial_type not in self.forced_choice_trial_types:
+                # 50% chance of reinforcement, equal chance of S+ or S- as
+                # informative. Both are decided by one draw (see first_ITI)
+                reinforced, feedback_color = self.noninformative_outcome_tuple[
+                    bisect(self.noninformative_cum_weights, self.random_draw())]
             # If forced non-informative
             else:
-                outcome = choice(self.forced_NI_choice_outcome_list) # Sample...
-                self.forced_NI_choice_outcome_list.remove(outcome) # ...without replacement
+                outcome = self.forced_NI_choice_outcome_list.pop() # Sample without replacement (list is pre-shuffled)
                 if outcome == "win":
                     reinforced = True
                 else:
                     reinforced = False
                     
-                feedback_color = choice(self.forced_NI_choice_feedback_list) # Sample...
-                self.forced_NI_choice_feedback_list.remove(feedback_color) # ...without replacement
+                feedback_color = self.forced_NI_choice_feedback_list.pop() # Sample without replacement (list is pre-shuffled)
                 
             
         # Then we need to set the feedback stimulus string (using the color dict)
-        self.feedback_stimulus = list(self.key_color_dict.keys())[list(self.key_color_dict.values()).index(feedback_color)]
+        self.feedback_stimulus = self.color_key_dict[feedback_color]
         
         # Then build the feedback key!
         self.build_keys()
         # Lastly, set the timer for the feedback duration (leading to either
         # reinforcement or just directly to the ITI)
         if reinforced:
-            self.feedback_timer = self.root.after(self.feedback_duration,
-                                                  self.provide_food)
+            self.feedback_timer = self.schedule(self.feedback_duration,
+                                                self.provide_food)
         else:
-            self.feedback_timer = self.root.after(self.feedback_duration,
-                                                  self.ITI)
+            self.feedback_timer = self.schedule(self.feedback_duration,
+                                                self.ITI)
         
-    def build_keys(self):
-        # This is a function that builds the all the buttons on the Tkinter
-        # Canvas. The Tkinter code (and geometry) may appear a little dense
-        # here, but it follows many of the same rules. Al keys will be built
-        # during non-ITI intervals, but they will only be filled in and active
-        # during specific times. However, pecks to keys will be differentiated
-        # regardless of activity.
+    def build_key_items(self):
+        # This function draws the background, every key that can appear
+        # during the session, the rejection covers and the onscreen text onto
+        # the Canvas exactly once, in a hidden state, when the MainScreen is
+        # first built. Rather than deleting and redrawing them every trial
+        # stage, build_keys() (etc.) just reveals the items it needs and
+        # clear_canvas() hides them again. Every one of these items is tagged
+        # "reusable_item" (so they can all be hidden at once), and every item
+        # of a key is also tagged both with "key" and with its own key string.
+        # The peck binding for all of the keys is attached to the "key" tag
+        # here, once.
         
         # First, build the background. This basically builds a button the size of 
         # screen to track any pecks; buttons built on top of this button will
         # NOT count as background pecks but as key pecks, because the object is
         # covering that part of the background. Once a peck is made, an event line
-        # is appended to the data matrix.
+        # is appended to the data matrix. Like the keys, it is only built once
+        # and then shown (by ITI and build_keys) or hidden (by clear_canvas),
+        # and its binding records pecks as whichever type of background peck
+        # (ITI or regular) is current.
+        self.background_event_type = "background_peck"
         self.mastercanvas.create_rectangle(0,0,
                                            self.mainscreen_width,
                                            self.mainscreen_height,
                                            fill = "black",
                                            outline = "black",
-                                           tag = "bkgrd")
+                                           state = "hidden",
+                                           tag = ("reusable_item", "bkgrd"))
         self.mastercanvas.tag_bind("bkgrd",
                                    "<Button-1>",
-                                   lambda event, 
-                                   event_type = "background_peck": 
-                                       self.write_data(event, event_type))
-        
-        # Nest, we update all the colors needed for this stage of the trial
+                                   self.background_peck)
         
-        # Coordinate dictionary for the shapes around a key. The keys are 
-        # given in [x1, y1, x2, y2] coordinates
-        key_coord_dict = {"left_choice_key": [150, 250, 250, 350],
-                          "right_choice_key": [550, 250, 650, 350],
-                          "rejection_key": [350, 250, 450, 350],
-                          "ll_feedback_key": [150, 250, 250, 350],
-                          "lr_feedback_key": [150, 250, 250, 350],
-                          "rl_feedback_key": [550, 250, 650, 350],
-                          "rr_feedback_key": [550, 250, 650, 350]
-                          }
-
-        # Now we need to select the keys to build for this specific trial...
-        key_str_list_to_build = []
-        if self.training_phase == 0: # If pre-training
-            key_str_list_to_build.append(self.trial_type)
-        elif self.training_phase == 1: # If pre-training
-            # For choice stage...
-            if self.trial_stage == 0:
-                if not self.rejected_trial:
-                    if self.trial_type in ["forced_choice-informative",
-                                           "rejection-informative",
-                                           "free_choice"]:
-                        key_str_list_to_build.append(f"{self.informative_side.lower()}_choice_key")
-                    if self.trial_type in ["rejection-noninformative",
-                                             "forced_choice-noninformative",
-                                             "free_choice"]:
-                        key_str_list_to_build.append(f"{self.noninformative_side.lower()}_choice_key")
-                    # For rejection trials, build rejection key...
-                    if self.trial_type in ["rejection-noninformative",
-                                           "rejection-informative"]:
-                        key_str_list_to_build.append("rejection_key")
-                else: # If rejectED trial
-                    if self.trial_type == "rejection-noninformative":
-                        key_str_list_to_build.append(f"{self.informative_side.lower()}_choice_key")
-                    elif self.trial_type == "rejection-informative":
-                        key_str_list_to_build.append(f"{self.noninformative_side.lower()}_choice_key")
-                    
-                            
-            # For feedback stage...
-            elif self.trial_stage == 1:
-                key_str_list_to_build.append(self.feedback_stimulus)
-                    
-        # Now that we have all the coordinates linked to each specific key,
-        # we can use a for loop to build each one.
-        for key_string in key_str_list_to_build:
+        key_coord_dict = self.key_coord_dict
+        self.key_oval_dict = {} # Canvas ID of each key's stimulus oval (filled in once colors are known)
+        self.key_peck_outcome_dict = {key_string: f"{key_string}_peck" for key_string
+                                      in key_coord_dict} # How a peck to each key is recorded (see ITI and key_press)
+        for key_string in key_coord_dict:
             # First up, build the actual circle that is the key and will
             # contain the stimulus. Order is important here, as shapes built
             # on top of each other will overlap/cover each other.
@@ -818,51 +1040,131 @@ class MainScreen(object):
                 key_coord_dict[key_string][3] + 25,
                 fill = "",
                 outline = "",
-                tag = key_string)
+                state = "hidden",
+                tag = ("reusable_item", "key", key_string))
 
-            self.mastercanvas.create_oval(
+            self.key_oval_dict[key_string] = self.mastercanvas.create_oval(
                 *key_coord_dict[key_string],
-                fill = self.key_color_dict[key_string],
+                fill = "",
                 outline = "",
-                tag = key_string)
+                state = "hidden",
+                tag = ("reusable_item", "key", key_string))
             
             # We'll have to identify rejection trials/keys and treat them 
             # differently and build a cross on top of the 
-            if "rejection_key" in key_string:
-                x1 = key_coord_dict[key_string][0]
-                x2 = key_coord_dict[key_string][2]
-                y1 = key_coord_dict[key_string][1]
-                y2 = key_coord_dict[key_string][3]
-                rect1_cords = [
-                    x1 + (x2-x1)/2 - (x2-x1)/10, # x1
-                    y1 + (y2-y1)/10, # y1
-                    x1 + (x2-x1)/2 + (x2-x1)/10, # x2
-                    y2 - (y2-y1)/10 # y2
-                    ]
-                rect2_cords = [
-                    x1 + (x2-x1)/10, # x1
-                    y1 + (y2-y1)/2 - (y2-y1)/10, # y1
-                    x2 - (x2-x1)/10, # x2
-                    y1 + (y2-y1)/2 + (y2-y1)/10 # y2
-                    ] 
-                self.mastercanvas.create_rectangle(
-                    *rect1_cords,
-                    fill = "purple",
-                    outline = "purple",
-                    tag = key_string)
-                self.mastercanvas.create_rectangle(
-                    *rect2_cords,
-                    fill = "purple",
-                    outline = "purple",
-                    tag = key_string)
-                
-                
-                
-            self.mastercanvas.tag_bind(
-                key_string,
-                "<Button-1>",
-                lambda event, key_string = key_string: self.key_press(event,
-                                                                    key_string))
+            if key_string == "rejection_key":
+                for rect_cords in self.rejection_cross_coords:
+                    self.mastercanvas.create_rectangle(
+                        *rect_cords,
+                        fill = "purple",
+                        outline = "purple",
+                        state = "hidden",
+                        tag = ("reusable_item", "key", key_string))
+
+        # Finally, a single binding on the shared "key" tag handles pecks to
+        # every key (see key_peck)
+        self.mastercanvas.tag_bind("key",
+                                   "<Button-1>",
+                                   self.key_peck)
+        
+        # Then the covers that black out both choice keys once a rejection
+        # key is pecked (see key_press). These are drawn after the keys, so
+        # they sit on top of them, and pecks to them count as background
+        # pecks.
+        for cover_cords in self.rejection_cover_coords:
+            self.mastercanvas.create_rectangle(*cover_cords,
+                                               fill = "black",
+                                               outline = "black",
+                                               state = "hidden",
+                                               tag = ("reusable_item", "cover"))
+        self.mastercanvas.tag_bind("cover",
+                                   "<Button-1>",
+                                   self.background_peck)
+        
+        # Lastly, the onscreen text shown during the ITI and reinforcement
+        # (only in test sessions or outside of the operant box). Their text
+        # is filled in when they're shown (see ITI and provide_food), since
+        # the durations they give aren't settled until the session starts.
+        self.mastercanvas.create_text(400,300,
+                                      fill="white",
+                                      font="Times 20 italic bold",
+                                      state = "hidden",
+                                      tag = ("reusable_item", "ITI_text"))
+        self.mastercanvas.create_text(400,300,
+                                      fill="white",
+                                      font="Times 20 italic bold",
+                                      state = "hidden",
+                                      tag = ("reusable_item", "food_text"))
+        
+    def key_peck(self, event):
+        # Pecks to any key arrive here. The key that was pecked is the key
+        # string among the tags of the Canvas item under the peck ("current"),
+        # which is passed on to key_press.
+        for tag in self.mastercanvas.gettags("current"):
+            if tag in self.key_coord_dict:
+                self.key_press(event, tag)
+                break
+    
+    def background_peck(self, event):
+        # Records a peck to the background (see build_key_items). A fast bout
+        # of pecking can deliver several of these at once, so rather than
+        # writing a row for each, only the first one is written (right away,
+        # so its time and trial information are those of the peck itself) and
+        # any others that arrive along with it are just counted onto that
+        # row's PeckCount, until Tkinter has caught up with its events or
+        # any other event is written (see write_background_pecks).
+        if self.background_peck_count:
+            self.background_peck_count += 1
+        else:
+            self.write_data(event, self.background_event_type)
+            self.background_peck_row_index = len(self.session_data_frame) - 1
+            self.background_peck_count = 1
+            self.background_peck_after_ID = self.root.after_idle(self.write_background_pecks)
+            self.pending_after_IDs.append(self.background_peck_after_ID)
+        
+    def write_background_pecks(self):
+        # Finishes the latest background peck row by filling in how many
+        # pecks it stands for, so that any later background peck starts a new
+        # row. This is called once Tkinter is idle, but also before any other
+        # data row is written (see write_data) and before the buffered rows
+        # are written to the .csv, so rows always stay in order.
+        if self.background_peck_count:
+            self.root.after_cancel(self.background_peck_after_ID) # (in case it hasn't gone off yet)
+            if self.background_peck_count > 1:
+                row_index = self.background_peck_row_index
+                self.session_data_frame[row_index] = self.session_data_frame[row_index][:-1] + (self.background_peck_count,)
+            self.background_peck_count = 0
+        
+    def build_keys(self):
+        # This is a function that shows the background and the keys
+        # needed for the current stage of the trial on the Tkinter Canvas (the
+        # keys themselves are drawn once, in build_key_items). Keys will be
+        # shown during non-ITI intervals, but they will only be filled in and
+        # active during specific times. However, pecks to keys will be
+        # differentiated regardless of activity.
+        
+        # First, show the background (see build_key_items), which records
+        # any pecks that miss the keys as background pecks. (Any ITI pecks
+        # still being counted are finished first, so they keep their type.)
+        self.write_background_pecks()
+        self.background_event_type = "background_peck"
+        self.mastercanvas.itemconfigure("bkgrd", state = "normal")
+        
+        # Now we need to select the keys to build for this specific trial...
+        if self.training_phase == 0: # If pre-training
+            key_str_list_to_build = (self.trial_type,)
+        elif self.trial_stage == 0: # For choice stage (looked up, see first_ITI)...
+            key_str_list_to_build = self.choice_keys_dict[(self.trial_type,
+                                                           self.rejected_trial)]
+        else: # For feedback stage...
+            key_str_list_to_build = (self.feedback_stimulus,)
+                    
+        # Every key was already drawn (hidden) in build_key_items(), so all
+        # that's left is to reveal the keys needed for this stage.
+        show_key = self.mastercanvas.itemconfigure
+        for key_string in key_str_list_to_build:
+            show_key(key_string, state = "normal")
+            
             
 # =============================================================================
 #         # If we're in a forced choice trial, we need to cover up the incorrect 
@@ -907,48 +1209,30 @@ class MainScreen(object):
     
     def key_press(self, event, keytag):
         # First, we always write data for the peck
-        if "rejection" not in keytag:
-            self.write_data(event, (f"{keytag}_peck"))
-        else:
-            if self.trial_type == "rejection-informative":
-                self.write_data(event, ("rejection-informative_peck"))
-            elif self.trial_type == "rejection-noninformative":
-                self.write_data(event, ("rejection-noninformative_peck"))
-            else:
-                print("ERROR")
+        self.write_data(event, self.key_peck_outcome_dict[keytag])
         # We need two different processes for different phase...
         # For pretraining
         if self.training_phase == 0:
             self.choice_key_FR -= 1 
-            if self.choice_key_FR == 0:
+            if self.choice_key_FR <= 0:
                 self.provide_food()
             else:
                 self.initial_links_stage()
         # For experimental task
         elif self.training_phase == 1:
             if self.trial_stage == 0:
-                if "rejection" in keytag:
+                if keytag == "rejection_key":
                     # If it'sthe first rejection key choice of a trial (else
                     # pass all this)
                     if not self.rejected_trial:
                         self.rejected_trial = True
-                        # Cover up the choice keys
-                        choice_key_coord_matrix = [[100, 200, 300, 400],
-                                                  [500, 200, 700, 400]]
-                        for c_list in choice_key_coord_matrix:
-                            self.mastercanvas.create_rectangle(*c_list,
-                                                               fill = "black",
-                                                               outline = "black",
-                                                               tag = "bkgrd")
-                        # Tag as background
-                        self.mastercanvas.tag_bind("bkgrd",
-                                                   "<Button-1>",
-                                                   lambda event, 
-                                                   event_type = "background_peck": 
-                                                       self.write_data(event, event_type))
+                        # Cover up the choice keys (the covers are drawn
+                        # once in build_key_items and hidden again by
+                        # clear_canvas)
+                        self.mastercanvas.itemconfigure("cover", state = "normal")
                         # Go back to initial links after the timer
-                        self.root.after(self.rejection_FI_duration,
-                                        self.initial_links_stage)
+                        self.schedule(self.rejection_FI_duration,
+                                      self.initial_links_stage)
                         
                 else:
                     self.choice = keytag
@@ -971,32 +1255,83 @@ class MainScreen(object):
         
         # If key is operantly reinforced
         if not operant_box_version or self.subject_ID == "TEST":
-            self.mastercanvas.create_text(400,300,
-                                          fill="white",
-                                          font="Times 20 italic bold", 
-                                          text=f"Food accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
+            self.mastercanvas.itemconfigure("food_text",
+                                            text = f"Food accessible ({int(self.hopper_duration/1000)} s)", # just onscreen feedback
+                                            state = "normal")
 
         if operant_box_version:
-            self.Hopper.change_hopper_state("On") # turn on hopper
-        self.root.after(self.hopper_duration,
-                        lambda: self.ITI())
+            self.change_hopper_state("On") # turn on hopper
+        self.schedule(self.hopper_duration,
+                      self.ITI)
         
 
     # %% Outside of the main loop functions, there are several additional
     # repeated functions that are called either outside of the loop or 
     # multiple times across phases.
     
-    def change_cursor_state(self):
+    def change_hopper_state(self, state):
+        # Raising or lowering the hopper means talking to the hardware, which
+        # can block. Instead of doing that inside a Tk callback, the request
+        # is handed to the hopper's worker thread; with only one worker, 
+        # requests are still carried out in the order they were made.
+        hopper_future = self.hopper_executor.submit(self.hopper_state_function,
+                                                    state)
+        hopper_future.add_done_callback(self.check_hopper_state_change)
+        return hopper_future
+    
+    def check_hopper_state_change(self, hopper_future):
+        # Errors raised in the worker thread would otherwise pass silently,
+        # so report them in the terminal.
+        if hopper_future.exception() is not None:
+            print(f"ERROR: Hopper state change failed ({hopper_future.exception()})")
+    
+    def print_trial_event(self, line):
+        # Terminal feedback for events within a trial isn't printed here, but
+        # queued up for print_queued_trial_events() to print on its own
+        # thread (see print_trial_events at the top).
+        if print_trial_events:
+            self.trial_event_queue.put(line + "\n")
+    
+    def print_queued_trial_events(self):
+        # This runs on the trial_event_printer thread for the whole session,
+        # printing queued terminal feedback as it comes in (and flushing
+        # whenever it has caught up) until it is handed None at the end of
+        # the session by stop_trial_event_printer().
+        trial_event_queue = self.trial_event_queue
+        while True:
+            line = trial_event_queue.get()
+            if line is None:
+                break
+            stdout.write(line)
+            if trial_event_queue.empty():
+                stdout.flush()
+        stdout.flush()
+    
+    def stop_trial_event_printer(self):
+        # Lets the printer thread finish printing everything still queued,
+        # then waits for it to stop.
+        if self.trial_event_printer.is_alive():
+            self.trial_event_queue.put(None)
+            self.trial_event_printer.join()
+    
+    def change_cursor_state(self, event = None):
         # This function toggles the cursor state on/off. 
         # May need to update accessibility settings on your machince.
-        if self.cursor_visible: # If cursor currently on...
-            self.root.config(cursor="none") # Turn off cursor
-            print("### Cursor turned off ###")
-            self.cursor_visible = False
-        else: # If cursor currently off...
+        # (event is only passed in when it's called by the "c" key binding)
+        self.set_cursor_state(not self.cursor_visible)
+    
+    def set_cursor_state(self, visible):
+        # Turns the cursor on (visible == True) or off. If it's already in
+        # that state, nothing needs to be done.
+        if visible == self.cursor_visible:
+            return
+        if visible:
             self.root.config(cursor="") # Turn on cursor
             print("### Cursor turned on ###")
-            self.cursor_visible = True
+        else:
+            self.root.config(cursor="none") # Turn off cursor
+            print("### Cursor turned off ###")
+        self.cursor_visible = visible
 # =============================================================================
 #                                                          
 #     def manual_reinforcer(self):
@@ -1021,24 +1356,44 @@ class MainScreen(object):
 #         
 # =============================================================================
     
+    def schedule(self, delay, callback):
+        # All of the session's timing is driven by Tkinter's after() timers
+        # (never sleep(), which would freeze the window and drop pecks). This
+        # wrapper schedules the callback and remembers its ID so that any
+        # timers still pending when the session is exited can be cancelled,
+        # rather than firing on a window that no longer exists.
+        after_ID = self.root.after(delay, callback)
+        self.pending_after_IDs.append(after_ID)
+        return after_ID
+    
+    def cancel_pending_timers(self):
+        # Cancels every timer scheduled so far (those that have already gone
+        # off are simply ignored by after_cancel) and starts a fresh list.
+        for after_ID in self.pending_after_IDs:
+            self.root.after_cancel(after_ID)
+        self.pending_after_IDs.clear()
+    
     def clear_canvas(self):
          # This is by far the most called function across the program. It
-         # deletes all the objects currently on the Canvas. A finer point to 
-         # note here is that objects still exist onscreen if they are covered
-         # up (rendering them invisible and inaccessible); if too many objects
-         # are stacked upon each other, it can may be too difficult to track/
-         # project at once (especially if many of the objects have functions 
-         # tied to them. Therefore, its important to frequently clean up the 
-         # Canvas by literally deleting every element.
+         # hides everything on the Canvas. A finer point to note here is that
+         # objects still exist onscreen if they are covered up (rendering them
+         # invisible and inaccessible); if too many objects are stacked upon
+         # each other, it can may be too difficult to track/project at once
+         # (especially if many of the objects have functions tied to them.
+         # Therefore, nothing is drawn during a trial: everything that can
+         # appear (keys, covers, background, text) was drawn once in
+         # build_key_items and tagged "reusable_item", so it can all be
+         # hidden here by that one tag and simply shown again when needed.
         try:
-            self.mastercanvas.delete("all")
+            self.mastercanvas.itemconfigure("reusable_item", state = "hidden")
         except TclError:
             print("No screen to exit")
         
-    def exit_program(self, event): 
+    def exit_program(self, event = None): 
         # This function can be called two different ways: automatically (when
         # time/reinforcer session constraints are reached) or manually (via the
-        # "End Program" button in the control panel or bound "esc" key).
+        # "End Program" button in the control panel, bound "esc" key or by
+        # closing the window).
             
         # The program does a few different things:
         #   1) Return hopper to down state, in case session was manually ended
@@ -1050,108 +1405,132 @@ class MainScreen(object):
         #       In the future, if we aren't using the paint object, we'll need 
         #       to 
         def other_exit_funcs():
-            if operant_box_version:
-                self.Hopper.change_hopper_state("Off")
-                # root.after_cancel(AFTER)
-                if not self.cursor_visible:
-                	self.change_cursor_state() # turn cursor back on, if applicable
-            self.write_comp_data(True) # write data for end of session
-            self.root.destroy() # destroy Canvas
-            print("\n GUI window exited")
+            try:
+                self.cancel_pending_timers() # Cancel any pending timers
+                if operant_box_version:
+                    self.change_hopper_state("Off")
+                    self.hopper_executor.shutdown(wait = True) # wait for the hopper to actually go down
+                    # root.after_cancel(AFTER)
+                    self.set_cursor_state(True) # turn cursor back on, if applicable
+                self.write_comp_data(True) # write data for end of session
+                self.stop_trial_event_printer() # print any remaining terminal feedback
+                self.root.destroy() # destroy Canvas
+                print("\n GUI window exited")
+            finally:
+                # Even if something above went wrong, the control panel has
+                # to be reset, or no other session could be started
+                if self.session_end_function is not None:
+                    self.session_end_function() # e.g., reset the control panel
             
         self.clear_canvas()
         other_exit_funcs()
         print("\n You may now exit the terminal and operater windows now.")
         if operant_box_version:
-            polygon_fill.main(self.subject_ID) # call paint object
+            try:
+                import polygon_fill
+            except ModuleNotFoundError:
+                print(missing_hopper_software_message)
+                input()
+            else:
+                # The paint object runs in its own process, so it doesn't
+                # hold up this program (and the control panel) until the
+                # paint window is closed. The data file and terminal feedback
+                # have already been finished above. The process is always
+                # started fresh ("spawn") rather than as a copy of this one,
+                # which still has the control panel's Tk window open.
+                get_context("spawn").Process(target = polygon_fill.main,
+                                             args = (self.subject_ID,)).start() # call paint object
         
     
     def write_data(self, event, outcome):
         # This function writes a new data line after EVERY peck. Data is
-        # organized into a matrix (just a list/vector with two dimensions,
-        # similar to a table). This matrix is appended to throughout the 
-        # session, then written to a .csv once at the end of the session.
+        # organized into a matrix (a list of fixed-length tuples, one per
+        # row, similar to a table) holding only the columns that can change
+        # during a session. Rows are appended to this matrix as they
+        # happen, then written to the .csv in a batch every ITI.
+        self.write_background_pecks() # Finish any background peck row before this one
         if event != None: 
             x, y = event.x, event.y
         else: # There are certain data events that are not pecks.
             x, y = "NA", "NA"
             
         # Next, we should translate the locational information from "outcome"
-        # into experimental data
-        if outcome in ["left_choice_key_peck", "right_choice_key_peck"]:
-            if self.informative_side.lower() in outcome:
-                exp_outcome = "informative_key_peck"
-            elif self.noninformative_side.lower() in outcome:
-                exp_outcome = "uninformative_key_peck"
-            else:
-                print("ERROR")
-        elif outcome in ["ll_feedback_key_peck", "lr_feedback_key_peck",
-                       "rl_feedback_key_peck", "rr_feedback_key_peck"]:
-            if self.key_color_dict[outcome[:-5]] == self.informative_Splus_color:
-                exp_outcome = "informative_Splus_peck"
-            elif self.key_color_dict[outcome[:-5]] == self.informative_Sminus_color:
-                exp_outcome = "informative_Sminus_peck"
-            elif self.key_color_dict[outcome[:-5]] == self.noninformative_Splus_color:
-                exp_outcome = "noninformative_Splus_peck"
-            elif self.key_color_dict[outcome[:-5]] == self.noninformative_Sminus_color:
-                exp_outcome = "noninformative_Sminus_peck"
-        elif "rejection" in outcome:
-            exp_outcome = "rejection_key_peck"
-        else:
-            exp_outcome = outcome
+        # into experimental data (see first_ITI for the translations). Events
+        # that aren't key pecks keep their own name.
+        exp_outcome = self.exp_outcome_dict.get(outcome, outcome)
             
             
-        print(f"{outcome:>30} | x: {x: ^3} y: {y:^3} | {self.trial_stage:^5} | {str(datetime.now() - self.start_time)} | {self.trial_type}")
+        # The clock is read once per event, and both the session and trial
+        # times are worked out from that one reading. The session time is
+        # kept as a whole number of microseconds here and only turned into
+        # H:MM:SS.ffffff when it's written to the .csv (see write_comp_data).
+        event_time = monotonic_ns()
+        session_time = (event_time - self.session_start) // 1000
+        # (these two are needed for both the terminal and the data row, so
+        # they're only looked up once)
+        trial_stage, trial_type = self.trial_stage, self.trial_type
+        
+        if print_trial_events:
+            self.print_trial_event(f"{outcome:>30} | x: {x: ^3} y: {y:^3} | {trial_stage:^5} | {timedelta(microseconds = session_time)} | {trial_type}")
         # print(f"{outcome:>30} | x: {x: ^3} y: {y:^3} | Target: {self.current_target_location: ^2} | {str(datetime.now() - self.start_time)}")
-        self.session_data_frame.append([
-            str(datetime.now() - self.start_time), # SessionTime as datetime object
+        self.session_data_frame.append((
+            session_time, # SessionTime in microseconds (written as H:MM:SS.ffffff)
             x, # X coordinate of a peck
             y, # Y coordinate of a peck
             outcome, # Type of event (e.g., background peck, target presentation, session end, etc.)
             exp_outcome, # translated location-independent outcome
-            self.trial_stage, # Substage within each trial (1 or 2)
-            round((time() - self.trial_start - (self.ITI_duration/1000)), 5), # Time into this trial minus ITI (if session ends during ITI, will be negative)
+            trial_stage, # Substage within each trial (1 or 2)
+            round((event_time - self.trial_start) / 1e9, 5), # Time into this trial (s) minus ITI (if session ends during ITI, will be negative)
             self.choice_key_FR, # FR of the current choice key (relevant later?)
             self.current_trial_counter, # Trial count within session (1 - max # trials)
             self.reinforcers_provided, # Reinforced trial counter
-            self.trial_type, # Trial type (e.g., "training", "CBE.1", etc.)
+            trial_type, # Trial type (e.g., "training", "CBE.1", etc.)
             self.rejected_trial, # Whether the second half is a rejected trial
-            self.rejection_FI_duration, # FI duration (fixed across session)
-            self.informative_prob, # Probability of an informative win
-            self.noninformative_prob, # Probability of a non-info win
-            self.subject_ID, # Name of subject (same across datasheet)
-            self.training_phase, # Phase of training as a number (0 - 7)
-            date.today() # Today's date as "MM-DD-YYYY"
-            ])
-        
-        
-        header_list = ["SessionTime", "Xcord","Ycord", "LocationEvent",
-                       "ExperimentalEvent", "TrialStage", "TrialTime", 
-                       "TrialFR", "TrialNum", "ReinforcersProvided", "TrialType",
-                       "RejectedTrial", "RejectionFIDuration", 
-                       "InformativeProbability", "NoninformativeProbability",
-                       "Subject", "TrainingPhase", "Date"] # Column headers
-
+            1 # PeckCount: number of pecks the row stands for (only ever raised for background pecks, see write_background_pecks)
+            )) # (the columns before PeckCount in the file are the same for every row, see session_row_tail)
 
+    def open_data_file(self):
+        # This function opens the session's .csv data document, named after
+        # the subject, date, and training phase, and writes the column
+        # headers to it. It is called once when the session starts; the file
+        # stays open for the rest of the session so that write_comp_data()
+        # only ever has to append the newest rows to it.
+        if self.record_data : # If experimenter has choosen to automatically record data in seperate sheet:
+            myFile_loc = f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P037_data-Phase{self.training_phase}.csv" # location of written .csv
+            self.data_file = open(myFile_loc, 'w', newline='', buffering = 1 << 20)
+            self.data_file.write(",".join(self.header_list) + "\r\n")
+            print(f"\n- Data file opened at {myFile_loc}")
         
     def write_comp_data(self, SessionEnded):
-        # The following function creates a .csv data document. It is either 
-        # called after each trial during the ITI (SessionEnded ==False) or 
-        # one the session finishes (SessionEnded). If the first time the 
-        # function is called, it will produce a new .csv out of the
-        # session_data_matrix variable, named after the subject, date, and
-        # training phase. Consecutive iterations of the function will simply
-        # write over the existing document.
+        # The following function writes to the .csv data document. It is 
+        # either called after each trial during the ITI (SessionEnded ==False)
+        # or once the session finishes (SessionEnded). Rows are buffered in
+        # session_data_frame as they happen, and each call formats that whole
+        # batch with row_format, writes it at once and then empties the buffer,
+        # so the data written each trial doesn't grow with the session. Once
+        # the session ends, the file is closed.
+        self.write_background_pecks() # The latest background peck row has to be finished before it's written
         if SessionEnded:
-            self.write_data(None, "SessionEnds") # Writes end of session to df
-        if self.record_data : # If experimenter has choosen to automatically record data in seperate sheet:
-            myFile_loc = f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P037_data-Phase{self.training_phase}.csv" # location of written .csv
-            # This loop writes the data in the matrix to the .csv              
-            edit_myFile = open(myFile_loc, 'w', newline='')
-            with edit_myFile as myFile:
-                w = writer(myFile, quoting=QUOTE_MINIMAL)
-                w.writerows(self.session_data_frame) # Write all event/trial data 
-            print(f"\n- Data file written to {myFile_loc}")
+            # If the program is exited before the first trial has started
+            # (e.g., the window is closed on the start screen or during the
+            # first ITI), there is no session data to end, so only the file
+            # (if it was opened) is closed.
+            if self.trial_start is not None:
+                self.write_data(None, "SessionEnds") # Writes end of session to df
+        elif not self.session_data_frame:
+            return # Nothing new to write since the last call
+        if self.data_file is not None: # Only if data is being recorded
+            row_format = self.row_format.format
+            row_tail = self.session_row_tail
+            self.data_file.writelines([row_format(timedelta(microseconds = session_time), *row, *row_tail, peck_count)
+                                       for session_time, *row, peck_count in self.session_data_frame]) # Write the buffered event/trial data
+            self.session_data_frame.clear()
+            self.data_file.flush()
+            if SessionEnded:
+                fsync(self.data_file.fileno()) # Make sure the data is actually on disk
+                print(f"\n- Data file written to {self.data_file.name}")
+                self.data_file.close()
+                self.data_file = None
                 
 #%% Finally, this is the code that actually runs:
     